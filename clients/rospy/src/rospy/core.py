@@ -155,6 +155,17 @@ def _frame_to_caller_id(frame):
     return pickle.dumps(caller_id)
 
 
+def _rosout_enabled_for(level):
+    """
+    @param level: logging level, e.g. logging.ERROR
+    @type  level: int
+    @return: True if logdebug(), logerr(), etc. would emit a message
+      at level
+    @rtype: bool
+    """
+    return logging.getLogger('rosout').isEnabledFor(level)
+
+
 def _base_logger(msg, args, kwargs, throttle=None,
                  throttle_identical=False, level=None, once=False):
 
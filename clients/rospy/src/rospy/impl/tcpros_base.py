@@ -677,6 +677,10 @@ class TCPROSTransport(Transport):
     def write_data(self, data):
         """
         Write raw data to transport
+        @param data: framed packet. On Python 3, publishers may pass a
+          memoryview of their serialization buffer, which is only valid
+          until this returns. On Python 2 it is always a str.
+        @type  data: str (Python 2), bytes or memoryview (Python 3)
         @raise TransportInitialiationError: could not be initialized
         @raise TransportTerminated: no longer open for publishing
         """
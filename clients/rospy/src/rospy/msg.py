@@ -123,11 +123,25 @@ def args_kwds_to_message(data_class, args, kwds):
         else:
             return data_class(*args)
 
+# 4-byte little-endian packet length that prefixes each message
+_struct_I = struct.Struct('<I')
+
+class _BytearrayWriter(object):
+    """
+    Minimal file-like wrapper that appends to a bytearray. Message
+    serialize() implementations only need write().
+    """
+    __slots__ = ['write']
+
+    def __init__(self, b):
+        self.write = b.extend
+
 def serialize_message(b, seq, msg):
     """
     Serialize the message to the buffer 
-    @param b: buffer to write to. WARNING: buffer will be reset after call
-    @type  b: StringIO
+    @param b: buffer to write to. WARNING: buffer will be reset after
+    call. If b is a bytearray, the message is appended to it.
+    @type  b: StringIO or bytearray
     @param msg: message to write
     @type  msg: Message
     @param seq: current sequence number (for headers)
@@ -136,8 +150,13 @@ def serialize_message(b, seq, msg):
     message. This is usually due to a type error with one of the
     fields.
     """
-    start = b.tell()
-    b.seek(start+4) #reserve 4-bytes for length
+    is_bytearray = isinstance(b, bytearray)
+    if is_bytearray:
+        start = len(b)
+        b.extend(b'\0\0\0\0') #reserve 4-bytes for length
+    else:
+        start = b.tell()
+        b.seek(start+4) #reserve 4-bytes for length
 
     #update Header object in top-level message
     if getattr(msg.__class__, "_has_header", False):
@@ -149,17 +168,20 @@ def serialize_message(b, seq, msg):
 
     #serialize the message data
     try:
-        msg.serialize(b)
+        msg.serialize(_BytearrayWriter(b) if is_bytearray else b)
     except struct.error as e:
         raise rospy.exceptions.ROSSerializationException(e)
 
     #write 4-byte packet length
     # -4 don't include size of length header
-    end = b.tell()
-    size = end - 4 - start
-    b.seek(start)
-    b.write(struct.pack('<I', size))
-    b.seek(end)
+    if is_bytearray:
+        _struct_I.pack_into(b, start, len(b) - 4 - start)
+    else:
+        end = b.tell()
+        size = end - 4 - start
+        b.seek(start)
+        b.write(_struct_I.pack(size))
+        b.seek(end)
    
 def deserialize_messages(b, msg_queue, data_class, queue_size=None, max_msgs=None, start=0):
     """
@@ -200,7 +222,7 @@ def deserialize_messages(b, msg_queue, data_class, queue_size=None, max_msgs=Non
             # - read in the packet length
             #   NOTE: size is not inclusive of itself.
             if size < 0 and left >= 4:
-                (size,) = struct.unpack('<I', b.read(4))
+                (size,) = _struct_I.unpack(b.read(4))
                 left -= 4
             # - deserialize the complete buffer
             if size > -1 and left >= size:
@@ -66,20 +66,20 @@ create classes that are children of these implementations.
 
 import struct
 import select
-try:
-    from cStringIO import StringIO #Python 2.x
+import sys
+if sys.version_info[0] < 3:
     python3 = 0
     def isstring(s):
         return isinstance(s, basestring) #Python 2.x
-except ImportError:
+else:
     python3 = 1
-    from io import StringIO, BytesIO #Python 3.x
     def isstring(s):
         return isinstance(s, str) #Python 3.x
 
 import threading
 import logging
 import time
+import weakref
 
 from itertools import chain
 import traceback
@@ -87,6 +87,7 @@ import traceback
 import rosgraph.names
 
 from rospy.core import *
+from rospy.core import _rosout_enabled_for
 from rospy.exceptions import ROSSerializationException, TransportTerminated
 from rospy.msg import serialize_message, args_kwds_to_message
 
@@ -101,6 +102,7 @@ _logger = logging.getLogger('rospy.topics')
 # wrap genpy implementation and map it to rospy namespace
 import genpy
 Message = genpy.Message
+_SerializationError = genpy.SerializationError
 
 #######################################################################
 # Base classes for all client-API instantiated pub/sub
@@ -112,6 +114,26 @@ Message = genpy.Message
 if not hasattr(select, 'EPOLLRDHUP'):
     select.EPOLLRDHUP = 0x2000
 
+# #2202 memoized results of rosgraph.names.is_legal_name(). Nodes
+# tend to create many Topic instances for the same few names.
+_legal_name_cache = {}
+_LEGAL_NAME_CACHE_SIZE = 4096
+
+def _is_legal_name(name):
+    """
+    Cached version of rosgraph.names.is_legal_name()
+    @param name: graph resource name
+    @type  name: str
+    @return: True if name is a legal ROS graph resource name
+    @rtype: bool
+    """
+    legal = _legal_name_cache.get(name, None)
+    if legal is None:
+        if len(_legal_name_cache) >= _LEGAL_NAME_CACHE_SIZE:
+            _legal_name_cache.clear()
+        legal = _legal_name_cache[name] = rosgraph.names.is_legal_name(name)
+    return legal
+
 
 class Topic(object):
     """Base class of L{Publisher} and L{Subscriber}"""
@@ -143,7 +165,7 @@ class Topic(object):
         if not issubclass(data_class, genpy.Message):
             raise ValueError("data_class [%s] is not a message data class"%data_class.__class__.__name__)
         # #2202
-        if not rosgraph.names.is_legal_name(name):
+        if not _is_legal_name(name):
             import warnings
             warnings.warn("'%s' is not a legal ROS graph resource name. This may cause problems with other ROS tools"%name, stacklevel=2)
         
@@ -261,12 +283,33 @@ class Poller(object):
         for x in e:
             self.kevents.remove(x)
             
+def _weak_remove_connection(impl):
+    """
+    Create a connection cleanup callback for impl that only holds a
+    weak reference to it. Passing impl.remove_connection directly
+    would create a reference cycle between impl and its connections,
+    which keeps impl (and its __del__) from being collected.
+    @param impl: topic implementation
+    @type  impl: L{_TopicImpl}
+    @return: cleanup callback
+    @rtype: fn(Transport)
+    """
+    impl_ref = weakref.ref(impl)
+    def remove_connection(c):
+        impl = impl_ref()
+        if impl is not None:
+            impl.remove_connection(c)
+    return remove_connection
+
 class _TopicImpl(object):
     """
     Base class of internal topic implementations. Each topic has a
     singleton _TopicImpl implementation for managing the underlying
     connections.
     """
+    __slots__ = ['resolved_name', 'name', 'data_class', 'type', 'handler',
+                 'seq', 'c_lock', 'connections', 'closed', 'ref_count',
+                 'connection_poll', '__weakref__']
     
     def __init__(self, name, data_class):
         """
@@ -287,13 +330,16 @@ class _TopicImpl(object):
         self.seq = 0
         # lock is used for to serialize call order that methods that
         # modify self.connections. Because add/removing connections is
-        # a rare event, we go through the extra hassle of making a
-        # copy of the connections/callbacks lists
-        # when modifying, then setting the reference to the new copy.
-        # With this pattern, other code can use these lists without
+        # a rare event, we go through the extra hassle of building a
+        # new tuple of connections/callbacks when modifying, then
+        # setting the reference to the new tuple. As tuples are
+        # immutable, other code can use these snapshots without
         # having to acquire c_lock
+        # NOTE: c_lock must remain reentrant. Closing a connection
+        # while holding c_lock (close(), _remove_connection()) invokes
+        # its cleanup callback, which is remove_connection().
         self.c_lock = threading.RLock()
-        self.connections = []
+        self.connections = ()
         self.closed = False
         # number of Topic instances using this
         self.ref_count = 0
@@ -304,13 +350,14 @@ class _TopicImpl(object):
         # very similar to close(), but have to be more careful in a __del__ what we call
         if self.closed:
             return
-        if self.connections is not None:
-            for c in self.connections:
+        connections = self.connections
+        if connections is not None:
+            self.connections = ()
+            for c in connections:
                 try:
                     c.close()
                 except:
                     pass
-            del self.connections[:]
         self.c_lock = self.connections = self.handler = self.data_class = self.type = None
 
     def close(self):
@@ -320,19 +367,27 @@ class _TopicImpl(object):
         self.closed = True
         if self.c_lock is not None:
             with self.c_lock:
-                for c in self.connections:
+                # detach the connections before closing them so that
+                # unlocked readers see either all of them or none
+                connections = self.connections
+                self.connections = ()
+                for c in connections:
                     try:
                         if c is not None:
                             c.close()
                     except:
                         # seems more logger.error internal than external logerr
                         _logger.error(traceback.format_exc())
-                del self.connections[:]
             self.handler = None
             
     def get_num_connections(self):
-        with self.c_lock:
-            return len(self.connections)
+        """
+        @return: number of connections. self.connections is an
+        immutable snapshot that is only ever rebound, so no lock is
+        necessary.
+        @rtype: int
+        """
+        return len(self.connections)
     
     def has_connection(self, endpoint_id):
         """
@@ -359,6 +414,14 @@ class _TopicImpl(object):
         return False
 
     def _remove_connection(self, connections, c):
+        """
+        @param connections: current connections snapshot
+        @type  connections: (Transport,)
+        @param c: connection instance to remove
+        @type  c: Transport
+        @return: new connections snapshot without c
+        @rtype: (Transport,)
+        """
         # Remove from poll instance as well as connections
         try:
             self.connection_poll.remove_fd(c.fileno())
@@ -374,13 +437,15 @@ class _TopicImpl(object):
         # connections might only contain the rospy.impl.tcpros_pubsub.QueuedConnection proxy
         # finding the "right" connection is more difficult then
         if c in connections:
-            connections.remove(c)
+            return tuple(x for x in connections if x is not c)
         # therefore additionally check for fileno equality if available
         elif c.fileno():
             matching_connections = [
                 conn for conn in connections if conn.fileno() == c.fileno()]
             if len(matching_connections) == 1:
-                connections.remove(matching_connections[0])
+                match = matching_connections[0]
+                return tuple(x for x in connections if x is not match)
+        return connections
 
     def add_connection(self, c):
         """
@@ -403,15 +468,15 @@ class _TopicImpl(object):
                 return False
 
             # c_lock is to make add_connection thread-safe, but we
-            # still make a copy of self.connections so that the rest of the
+            # still build a new tuple for self.connections so that the rest of the
             # code can use self.connections in an unlocked manner
-            new_connections = self.connections[:]
+            new_connections = self.connections
 
             # if we have a connection to the same endpoint_id, drop
             # the old one.
             for oldc in self.connections:
                 if oldc.endpoint_id == c.endpoint_id:
-                    self._remove_connection(new_connections, oldc)
+                    new_connections = self._remove_connection(new_connections, oldc)
 
             # #3808: "garbage collect" bad sockets whenever we add new
             # connections. This allows at most one stale connection
@@ -431,7 +496,7 @@ class _TopicImpl(object):
                 to_remove = [x for x in new_connections if x.fileno() == fd]
                 for x in to_remove:
                     rospydebug("removing connection to %s, connection error detected"%(x.endpoint_id))
-                    self._remove_connection(new_connections, x)
+                    new_connections = self._remove_connection(new_connections, x)
 
             # Add new connection to poller, register for all events,
             # though we only care about POLLHUP/ERR
@@ -440,17 +505,15 @@ class _TopicImpl(object):
                 self.connection_poll.add_fd(new_fd)
             
             # add in new connection
-            new_connections.append(c)
-
-            self.connections = new_connections
+            self.connections = new_connections + (c,)
 
             # connections make a callback when closed
             # don't clobber an existing callback
             if not c.cleanup_cb:
-                c.set_cleanup_callback(self.remove_connection)
+                c.set_cleanup_callback(_weak_remove_connection(self))
             else:
                 previous_callback = c.cleanup_cb
-                new_callback = self.remove_connection
+                new_callback = _weak_remove_connection(self)
                 def cleanup_cb_wrapper(s):
                     new_callback(s)
                     previous_callback(s)
@@ -462,11 +525,11 @@ class _TopicImpl(object):
         fds_to_remove = list(self.connection_poll.error_iter())
         if fds_to_remove:
             with self.c_lock:
-                new_connections = self.connections[:]
+                new_connections = self.connections
                 to_remove = [x for x in new_connections if x.fileno() in fds_to_remove]
                 for x in to_remove:
                     rospydebug("removing connection to %s, connection error detected"%(x.endpoint_id))
-                    self._remove_connection(new_connections, x)
+                    new_connections = self._remove_connection(new_connections, x)
                 self.connections = new_connections
 
     def remove_connection(self, c):
@@ -478,11 +541,9 @@ class _TopicImpl(object):
         rospyinfo("topic[%s] removing connection to %s"%(self.resolved_name, c.endpoint_id))
         with self.c_lock:
             # c_lock is to make remove_connection thread-safe, but we
-            # still make a copy of self.connections so that the rest of the
-            # code can use self.connections in an unlocked manner            
-            new_connections = self.connections[:]
-            self._remove_connection(new_connections, c)
-            self.connections = new_connections
+            # still build a new tuple for self.connections so that the rest of the
+            # code can use self.connections in an unlocked manner
+            self.connections = self._remove_connection(self.connections, c)
 
     def get_stats_info(self): # STATS
         """
@@ -496,7 +557,8 @@ class _TopicImpl(object):
         """
         # save referenceto avoid locking
         connections = self.connections
-        return [(c.id, c.endpoint_id, c.direction, c.transport_type, self.resolved_name, True, c.get_transport_info()) for c in connections]
+        resolved_name = self.resolved_name
+        return [(c.id, c.endpoint_id, c.direction, c.transport_type, resolved_name, True, c.get_transport_info()) for c in connections]
 
     def get_stats(self): # STATS
         """Get the stats for this topic (API stub)"""
@@ -601,6 +663,8 @@ class _SubscriberImpl(_TopicImpl):
     """
     Underyling L{_TopicImpl} implementation for subscriptions.
     """
+    __slots__ = ['callbacks', 'queue_size', 'buff_size', 'tcp_nodelay',
+                 'statistics_logger']
     def __init__(self, name, data_class):
         """
         ctor.
@@ -611,9 +675,9 @@ class _SubscriberImpl(_TopicImpl):
         """
         super(_SubscriberImpl, self).__init__(name, data_class)
         # client-methods to invoke on new messages. should only modify
-        # under lock. This is a list of 2-tuples (fn, args), where
+        # under lock. This is a tuple of 2-tuples (fn, args), where
         # args are additional arguments for the callback, or None
-        self.callbacks = [] 
+        self.callbacks = ()
         self.queue_size = None
         self.buff_size = DEFAULT_BUFF_SIZE
         self.tcp_nodelay = False
@@ -624,9 +688,7 @@ class _SubscriberImpl(_TopicImpl):
     def close(self):
         """close I/O and release resources"""
         _TopicImpl.close(self)
-        if self.callbacks:
-            del self.callbacks[:]
-            self.callbacks = None
+        self.callbacks = ()
         if self.statistics_logger:
             self.statistics_logger.shutdown()
             self.statistics_logger = None
@@ -700,15 +762,16 @@ class _SubscriberImpl(_TopicImpl):
             raise ROSException("subscriber [%s] has been closed"%(self.resolved_name))
         with self.c_lock:
             # we lock in order to serialize calls to add_callback, but
-            # we copy self.callbacks so we can it
-            new_callbacks = self.callbacks[:]
-            new_callbacks.append((cb, cb_args))
-            self.callbacks = new_callbacks
+            # we build a new tuple so that self.callbacks can be used unlocked
+            self.callbacks = self.callbacks + ((cb, cb_args),)
 
-        # #1852: invoke callback with any latched messages
+        # #1852: invoke callback with any latched messages. The latch
+        # of a connection is only known once messages arrive, so it
+        # has to be checked here rather than tracked on add_connection().
         for c in self.connections:
-            if c.latch is not None:
-                self._invoke_callback(c.latch, cb, cb_args)
+            latch = c.latch
+            if latch is not None:
+                self._invoke_callback(latch, cb, cb_args)
 
     def remove_callback(self, cb, cb_args):
         """
@@ -723,15 +786,14 @@ class _SubscriberImpl(_TopicImpl):
             return
         with self.c_lock:
             # we lock in order to serialize calls to add_callback, but
-            # we copy self.callbacks so we can it
-            matches = [x for x in self.callbacks if x[0] == cb and x[1] == cb_args]
-            if matches:
-                new_callbacks = self.callbacks[:]
-                # remove the first match
-                new_callbacks.remove(matches[0])
-                self.callbacks = new_callbacks
-        if not matches:
-            raise KeyError("no matching cb")
+            # we build a new tuple so that self.callbacks can be used unlocked
+            callbacks = self.callbacks
+            # find and remove the first match in a single pass
+            for i, x in enumerate(callbacks):
+                if x[0] == cb and x[1] == cb_args:
+                    self.callbacks = callbacks[:i] + callbacks[i+1:]
+                    return
+        raise KeyError("no matching cb")
 
     def _invoke_callback(self, msg, cb, cb_args):
         """
@@ -748,12 +810,24 @@ class _SubscriberImpl(_TopicImpl):
                 cb(msg, cb_args)
             else:
                 cb(msg)
-        except Exception as e:
-            if not is_shutdown():
-                logerr("bad callback: %s\n%s"%(cb, traceback.format_exc()))
-            else:
-                _logger.warn("during shutdown, bad callback: %s\n%s"%(cb, traceback.format_exc()))
-        
+        except Exception:
+            self._log_cb_error(cb, sys.exc_info())
+
+    def _log_cb_error(self, cb, exc_info):
+        """
+        Log the exception raised by a callback. The traceback is only
+        formatted if the message will actually be emitted.
+        @param cb: callback
+        @type  cb: fn(msg, cb_args)
+        @param exc_info: exception info as returned by sys.exc_info()
+        @type  exc_info: (type, Exception, traceback)
+        """
+        if not is_shutdown():
+            if _rosout_enabled_for(logging.ERROR):
+                logerr("bad callback: %s\n%s"%(cb, ''.join(traceback.format_exception(*exc_info))))
+        elif _logger.isEnabledFor(logging.WARNING):
+            _logger.warn("during shutdown, bad callback: %s\n%s"%(cb, ''.join(traceback.format_exception(*exc_info))))
+
     def receive_callback(self, msgs, connection):
         """
         Called by underlying connection transport for each new message received
@@ -762,11 +836,37 @@ class _SubscriberImpl(_TopicImpl):
         """
         # save reference to avoid lock
         callbacks = self.callbacks
+        if not callbacks and not self.statistics_logger:
+            # no one to hand the messages to
+            return
+        if len(callbacks) == 1 and callbacks[0][1] is None:
+            # fast path for the common case of a single callback
+            # without callback args
+            cb = callbacks[0][0]
+            for msg in msgs:
+                # re-read per message as close() may release the logger
+                statistics_logger = self.statistics_logger
+                if statistics_logger:
+                    statistics_logger.callback(msg, connection.callerid_pub, connection.stat_bytes)
+                try:
+                    cb(msg)
+                except Exception:
+                    self._log_cb_error(cb, sys.exc_info())
+            return
         for msg in msgs:
-            if self.statistics_logger:
-                self.statistics_logger.callback(msg, connection.callerid_pub, connection.stat_bytes)
+            statistics_logger = self.statistics_logger
+            if statistics_logger:
+                statistics_logger.callback(msg, connection.callerid_pub, connection.stat_bytes)
+            # dispatch inline rather than through _invoke_callback() to
+            # save a method call per message and callback
             for cb, cb_args in callbacks:
-                self._invoke_callback(msg, cb, cb_args)
+                try:
+                    if cb_args is not None:
+                        cb(msg, cb_args)
+                    else:
+                        cb(msg)
+                except Exception:
+                    self._log_cb_error(cb, sys.exc_info())
 
 class SubscribeListener(object):
     """
@@ -872,25 +972,31 @@ class Publisher(Topic):
         @raise ROSSerializationException: If unable to serialize
         message. This is usually a type error with one of the fields.
         """
-        if self.impl is None:
+        impl = self.impl
+        if impl is None:
             raise ROSException("publish() to an unregistered() handle")
         if not is_initialized():
             raise ROSException("ROS node has not been initialized yet. Please call init_node() first")
-        data = args_kwds_to_message(self.data_class, args, kwds)
+        # fast path for the common case of publishing a message instance
+        if len(args) == 1 and not kwds and isinstance(args[0], self.data_class):
+            data = args[0]
+        else:
+            data = args_kwds_to_message(self.data_class, args, kwds)
         try:
-            self.impl.acquire()
-            self.impl.publish(data)
-        except genpy.SerializationError as e:
+            with impl:
+                impl.publish(data)
+        except _SerializationError as e:
             # can't go to rospy.logerr(), b/c this could potentially recurse
             _logger.error(traceback.format_exc())
             raise ROSSerializationException(str(e))
-        finally:
-            self.impl.release()            
 
 class _PublisherImpl(_TopicImpl):
     """
     Underyling L{_TopicImpl} implementation for publishers.
     """
+    __slots__ = ['buff', 'publock', 'subscriber_listeners', 'headers',
+                 'is_latch', 'latch', 'queue_size', 'message_data_sent',
+                 'in_publish']
     
     def __init__(self, name, data_class):
         """
@@ -900,11 +1006,19 @@ class _PublisherImpl(_TopicImpl):
         @type  data_class: L{Message} class
         """
         super(_PublisherImpl, self).__init__(name, data_class)
-        if python3 == 0:
-            self.buff = StringIO()
-        else:
-            self.buff = BytesIO()
-        self.publock = threading.RLock() #for acquire()/release
+        # reusable serialization buffer for publish(). Calls to
+        # publish() are serialized by publock, so one buffer per
+        # publisher is enough and no shared pool (with its own
+        # locking) is needed.
+        self.buff = bytearray()
+        # True while publish() is using self.buff
+        self.in_publish = False
+        # for acquire()/release. NOTE: publock must remain reentrant.
+        # A failed write in publish() closes the connection, whose
+        # cleanup callback calls remove_connection() and thereby
+        # SubscribeListener.peer_unsubscribe(), which may publish on
+        # this topic again from the same thread.
+        self.publock = threading.RLock()
         self.subscriber_listeners = []
 
         # additional client connection headers
@@ -928,8 +1042,6 @@ class _PublisherImpl(_TopicImpl):
             del self.subscriber_listeners[:]
         if self.headers:
             self.headers.clear()
-        if self.buff is not None:
-            self.buff.close()
         self.publock = self.headers = self.buff = self.subscriber_listeners = None
 
     def add_headers(self, headers):
@@ -982,6 +1094,15 @@ class _PublisherImpl(_TopicImpl):
         """lock for thread-safe publishing to this transport"""
         if self.publock is not None:
             self.publock.release()
+
+    def __enter__(self):
+        """acquire() using the with statement"""
+        self.acquire()
+        return self
+
+    def __exit__(self, *args):
+        """release() using the with statement"""
+        self.release()
         
     def add_connection(self, c):
         """
@@ -996,10 +1117,14 @@ class _PublisherImpl(_TopicImpl):
         if self.queue_size is not None:
             c = QueuedConnection(c, self.queue_size)
         super(_PublisherImpl, self).add_connection(c)
-        def publish_single(data):
-            self.publish(data, connection_override=c)
-        for l in self.subscriber_listeners:
-            l.peer_subscribe(self.resolved_name, self.publish, publish_single)
+        # listeners are rare, so skip creating publish_single otherwise
+        if self.subscriber_listeners:
+            publish = self.publish
+            def publish_single(data):
+                publish(data, connection_override=c)
+            name = self.resolved_name
+            for l in self.subscriber_listeners:
+                l.peer_subscribe(name, publish, publish_single)
         if self.is_latch and self.latch is not None:
             with self.publock:
                 self.publish(self.latch, connection_override=c)
@@ -1012,9 +1137,11 @@ class _PublisherImpl(_TopicImpl):
         @type  c: L{Transport}
         """
         super(_PublisherImpl, self).remove_connection(c)
-        num = len(self.connections)                
-        for l in self.subscriber_listeners:
-            l.peer_unsubscribe(self.resolved_name, num)
+        if self.subscriber_listeners:
+            name = self.resolved_name
+            num = len(self.connections)
+            for l in self.subscriber_listeners:
+                l.peer_unsubscribe(name, num)
             
     def publish(self, message, connection_override=None):
         """
@@ -1045,47 +1172,79 @@ class _PublisherImpl(_TopicImpl):
         if self.is_latch:
             self.latch = message
 
-        if not self.has_connections():
-            #publish() falls through
-            return False
-
         if connection_override is None:
-            #copy connections so we can iterate safely
+            # connections is an immutable tuple that is replaced, not
+            # modified, on add/remove, so it is safe to iterate as is
             conns = self.connections
+            if not conns:
+                #publish() falls through
+                return False
         else:
-            conns = [connection_override]
+            conns = (connection_override,)
 
-        # #2128 test our buffer. I don't now how this got closed in
-        # that case, but we can at least diagnose the problem.
+        # #2128 test our buffer. It is released if the topic is closed
+        # during publish(), so we can at least diagnose the problem.
         b = self.buff
+        # errors are rare, so only allocate the list on failure
+        err_con = None
         try:
-            b.tell()
-
-            # serialize the message
-            self.seq += 1 #count messages published to the topic
-            serialize_message(b, self.seq, message)
-
-            # send the buffer to all connections
-            err_con = []
-            data = b.getvalue()
+            if b is None:
+                raise ValueError("publish buffer has been released")
+            reentered = self.in_publish
+            if reentered:
+                # publish() was re-entered (see publock) while the
+                # outer call is still writing the buffer, leave it be
+                b = bytearray()
+            self.in_publish = True
+            data = None
+            try:
+                # serialize the message
+                self.seq += 1 #count messages published to the topic
+                serialize_message(b, self.seq, message)
+
+                # send the buffer to all connections. The buffer already
+                # holds the complete length-prefixed packet, so each
+                # connection sends it with a single write. QueuedConnection
+                # holds on to the data after write_data() returns, so it
+                # needs its own copy. On Python 2, transports expect a str
+                # (str + memoryview raises TypeError). Otherwise the buffer
+                # is sent without copying it.
+                if self.queue_size is None and python3 == 1:
+                    data = memoryview(b)
+                else:
+                    data = bytes(b)
 
-            for c in conns:
-                try:
-                    if not is_shutdown():
+                # check for shutdown once rather than per connection. All
+                # connections share the same data.
+                if is_shutdown():
+                    conns = ()
+                for c in conns:
+                    try:
                         c.write_data(data)
-                except TransportTerminated as e:
-                    logdebug("publisher connection to [%s] terminated, see errorlog for details:\n%s"%(c.endpoint_id, traceback.format_exc()))
-                    err_con.append(c)
-                except Exception as e:
-                    # greater severity level
-                    logdebug("publisher connection to [%s] terminated, see errorlog for details:\n%s"%(c.endpoint_id, traceback.format_exc()))
-                    err_con.append(c)
-
-            # reset the buffer and update stats
-            self.message_data_sent += b.tell() #STATS
-            b.seek(0)
-            b.truncate(0)
-            
+                    except TransportTerminated as e:
+                        logdebug("publisher connection to [%s] terminated, see errorlog for details:\n%s"%(c.endpoint_id, traceback.format_exc()))
+                        if err_con is None:
+                            err_con = []
+                        err_con.append(c)
+                    except Exception as e:
+                        # greater severity level
+                        logdebug("publisher connection to [%s] terminated, see errorlog for details:\n%s"%(c.endpoint_id, traceback.format_exc()))
+                        if err_con is None:
+                            err_con = []
+                        err_con.append(c)
+
+                self.message_data_sent += len(b) #STATS
+            finally:
+                self.in_publish = reentered
+                # reset the buffer, also if serialization failed part-way
+                del data
+                try:
+                    del b[:]
+                except BufferError:
+                    # a transport kept a view of the buffer, leave it to it
+                    if b is self.buff:
+                        self.buff = bytearray()
+
         except ValueError:
             # operations on self.buff can fail if topic is closed
             # during publish, which often happens during Ctrl-C.
@@ -1104,13 +1263,14 @@ class _PublisherImpl(_TopicImpl):
                 raise
 
         # remove any bad connections
-        for c in err_con:
-            try:
-                # connection will callback into remove_connection when
-                # we close it
-                c.close()
-            except:
-                pass
+        if err_con:
+            for c in err_con:
+                try:
+                    # connection will callback into remove_connection when
+                    # we close it
+                    c.close()
+                except:
+                    pass
 
 #################################################################################
 # TOPIC MANAGER/LISTENER
@@ -1120,15 +1280,37 @@ class _TopicManager(object):
     Tracks Topic objects
     See L{get_topic_manager()} for singleton access
     """
-    
+    __slots__ = ['pubs', 'subs', 'topics', 'lock', 'closed',
+                 '_pub_version', '_sub_version', '_pub_list', '_sub_list',
+                 '_notify_lock']
+
     def __init__(self):
         """ctor."""
         super(_TopicManager, self).__init__()
         self.pubs = {} #: { topic: _PublisherImpl }
         self.subs = {} #: { topic: _SubscriberImpl }
         self.topics = set() # [str] list of topic names
-        self.lock = threading.Condition()
+        # nothing waits on or notifies this lock, so it does not need
+        # to be a Condition. It must stay reentrant: acquire_impl()
+        # and release_impl() call _add() and _remove() with it held.
+        self.lock = threading.RLock()
         self.closed = False
+        # cached get_publications()/get_subscriptions() results as
+        # (version, list) pairs. _add() and _remove() bump the version
+        # when pubs or subs change, and the getters rebuild a cached
+        # list whose version is out of date. A rebuild that races a
+        # change is stored with the old version, so it is never used.
+        self._pub_version = self._sub_version = 0
+        self._pub_list = self._sub_list = None
+        # registration listeners are notified without holding
+        # self.lock. Creating or deleting an impl and notifying the
+        # listeners of it both happen under _notify_lock, so the
+        # notifications are made in the same order as the changes they
+        # report, e.g. a topic's removal before its re-creation.
+        # NOTE: _notify_lock must be taken before self.lock, never
+        # while holding it, so that self.lock is not held while
+        # waiting for a slow notification.
+        self._notify_lock = threading.Lock()
         _logger.info("topicmanager initialized")
 
     def get_pub_sub_info(self):
@@ -1138,11 +1320,13 @@ class _TopicManager(object):
           See getBusInfo() API for more data structure details.
         @rtype: list
         """
+        # only hold the lock long enough to snapshot the impls
         with self.lock:
-            info = []
-            for s in chain(iter(self.pubs.values()), iter(self.subs.values())):
-                info.extend(s.get_stats_info())
-            return info
+            impls = list(chain(self.pubs.values(), self.subs.values()))
+        info = []
+        for s in impls:
+            info.extend(s.get_stats_info())
+        return info
             
     def get_pub_sub_stats(self):
         """
@@ -1151,9 +1335,12 @@ class _TopicManager(object):
           See getBusStats() API for more data structure details.
         @rtype: list
         """
+        # only hold the lock long enough to snapshot the impls
         with self.lock:
-            return [s.get_stats() for s in self.pubs.values()],\
-                   [s.get_stats() for s in self.subs.values()]
+            pubs = list(self.pubs.values())
+            subs = list(self.subs.values())
+        return [s.get_stats() for s in pubs],\
+               [s.get_stats() for s in subs]
             
     def close_all(self):
         """
@@ -1166,6 +1353,8 @@ class _TopicManager(object):
                 t.close()
             self.pubs.clear()
             self.subs.clear()        
+            self._pub_version += 1
+            self._sub_version += 1
 
             
     def check_all(self):
@@ -1178,7 +1367,9 @@ class _TopicManager(object):
         
     def _add(self, ps, rmap, reg_type):
         """
-        Add L{_TopicImpl} instance to rmap
+        Add L{_TopicImpl} instance to rmap. The caller must hold
+        _notify_lock and self.lock, and notify the registration
+        listeners once it has released self.lock.
         @param ps: a pub/sub impl instance
         @type  ps: L{_TopicImpl}
         @param rmap: { topic: _TopicImpl} rmap to record instance in
@@ -1191,19 +1382,13 @@ class _TopicManager(object):
         with self.lock:
             rmap[resolved_name] = ps
             self.topics.add(resolved_name)
-            
-            # NOTE: this call can take a lengthy amount of time (at
-            # least until its reimplemented to use queues)
-            get_registration_listeners().notify_added(resolved_name, ps.type, reg_type)
+            self._invalidate_list(rmap)
 
-    def _recalculate_topics(self):
-        """recalculate self.topics. expensive"""
-        self.topics = set([x.resolved_name for x in self.pubs.values()] +
-                          [x.resolved_name for x in self.subs.values()])
-    
     def _remove(self, ps, rmap, reg_type):
         """
-        Remove L{_TopicImpl} instance from rmap
+        Remove L{_TopicImpl} instance from rmap. The caller must hold
+        _notify_lock and self.lock, and notify the registration
+        listeners once it has released self.lock.
         @param ps: a pub/sub impl instance
         @type  ps: L{_TopicImpl}
         @param rmap: topic->_TopicImpl rmap to remove instance in
@@ -1215,11 +1400,10 @@ class _TopicManager(object):
         _logger.debug("tm._remove: %s, %s, %s", resolved_name, ps.type, reg_type)
         with self.lock:
             del rmap[resolved_name]
-            self. _recalculate_topics()
-            
-            # NOTE: this call can take a lengthy amount of time (at
-            # least until its reimplemented to use queues)
-            get_registration_listeners().notify_removed(resolved_name, ps.type, reg_type)
+            # topic may still be in use by the other registration type
+            if resolved_name not in self.pubs and resolved_name not in self.subs:
+                self.topics.discard(resolved_name)
+            self._invalidate_list(rmap)
 
     def get_impl(self, reg_type, resolved_name):
         """
@@ -1267,11 +1451,25 @@ class _TopicManager(object):
             raise TypeError("invalid reg_type: %s"%reg_type)
         with self.lock:
             impl = rmap.get(resolved_name, None)            
-            if not impl:
+            if impl:
+                impl.ref_count += 1
+                return impl
+        # creating the impl has to be reported, see _notify_lock
+        with self._notify_lock:
+            with self.lock:
+                # another thread may have created it in the meantime
+                impl = rmap.get(resolved_name, None)
+                if impl:
+                    impl.ref_count += 1
+                    return impl
                 impl = impl_class(resolved_name, data_class)
                 self._add(impl, rmap, reg_type)
-            impl.ref_count += 1
-            return impl
+                impl.ref_count += 1
+            # NOTE: this call can take a lengthy amount of time (at
+            # least until its reimplemented to use queues), so it is
+            # made without holding the lock
+            get_registration_listeners().notify_added(resolved_name, impl.type, reg_type)
+        return impl
 
     def release_impl(self, reg_type, resolved_name):
         """
@@ -1298,14 +1496,31 @@ class _TopicManager(object):
                 return
             impl = rmap.get(resolved_name, None)
             assert impl is not None, "cannot release topic impl as impl [%s] does not exist"%resolved_name
-            impl.ref_count -= 1
-            assert impl.ref_count >= 0, "topic impl's reference count has gone below zero"
-            if impl.ref_count == 0:
+            if impl.ref_count > 1:
+                impl.ref_count -= 1
+                return
+        # deleting the impl has to be reported, see _notify_lock
+        with self._notify_lock:
+            with self.lock:
+                # state may have changed while waiting for _notify_lock
+                if self.closed:
+                    return
+                impl = rmap.get(resolved_name, None)
+                assert impl is not None, "cannot release topic impl as impl [%s] does not exist"%resolved_name
+                impl.ref_count -= 1
+                assert impl.ref_count >= 0, "topic impl's reference count has gone below zero"
+                if impl.ref_count != 0:
+                    return
                 rospyinfo("topic impl's ref count is zero, deleting topic %s...", resolved_name)
                 impl.close()
                 self._remove(impl, rmap, reg_type)
+                data_type = impl.type
                 del impl
-                _logger.debug("... done deleting topic %s", resolved_name)
+            # NOTE: this call can take a lengthy amount of time (at
+            # least until its reimplemented to use queues), so it is
+            # made without holding the lock
+            get_registration_listeners().notify_removed(resolved_name, data_type, reg_type)
+        _logger.debug("... done deleting topic %s", resolved_name)
                 
     def get_publisher_impl(self, resolved_name):
         """
@@ -1350,16 +1565,38 @@ class _TopicManager(object):
         """                
         return self.topics.copy()
     
+    def _invalidate_list(self, rmap):
+        """
+        Mark the cached get_publications() or get_subscriptions()
+        result for rmap as out of date. The caller must hold self.lock
+        and have already modified rmap.
+        @param rmap: self.pubs or self.subs
+        @type  rmap: dict
+        """
+        if rmap is self.pubs:
+            self._pub_version += 1
+        else:
+            self._sub_version += 1
+
     def _get_list(self, rmap):
-        return [[k, v.type] for k, v in rmap.items()]
+        # snapshot the items first, as rmap may change concurrently
+        return tuple([(k, v.type) for k, v in tuple(rmap.items())])
 
-    ## @return [[str,str],]: list of topics subscribed to by this node, [ [topic1, topicType1]...[topicN, topicTypeN]]
+    ## @return [(str,str),]: list of topics subscribed to by this node, [ (topic1, topicType1)...(topicN, topicTypeN)]
     def get_subscriptions(self):
-        return self._get_list(self.subs)
+        version = self._sub_version
+        cache = self._sub_list
+        if cache is None or cache[0] != version:
+            cache = self._sub_list = (version, self._get_list(self.subs))
+        return list(cache[1])
 
-    ## @return [[str,str],]: list of topics published by this node, [ [topic1, topicType1]...[topicN, topicTypeN]]
+    ## @return [(str,str),]: list of topics published by this node, [ (topic1, topicType1)...(topicN, topicTypeN)]
     def get_publications(self):
-        return self._get_list(self.pubs)
+        version = self._pub_version
+        cache = self._pub_list
+        if cache is None or cache[0] != version:
+            cache = self._pub_list = (version, self._get_list(self.pubs))
+        return list(cache[1])
 
 set_topic_manager(_TopicManager())
 
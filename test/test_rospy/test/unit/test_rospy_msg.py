@@ -105,8 +105,30 @@ class TestRospyMsg(unittest.TestCase):
         self.assertEquals(valid*3, buff.getvalue())        
         rospy.msg.serialize_message(buff, seq, val)
         self.assertEquals(valid*3, buff.getvalue()) 
-        rospy.msg.serialize_message(buff, seq, val)        
-        self.assertEquals(valid*3, buff.getvalue())        
+        rospy.msg.serialize_message(buff, seq, val)
+        self.assertEquals(valid*3, buff.getvalue())
+
+        #test serialization into a bytearray, which is appended to
+        b = bytearray()
+        rospy.msg.serialize_message(b, seq, val)
+        self.assertEquals(valid, bytes(b))
+        rospy.msg.serialize_message(b, seq, val)
+        self.assertEquals(valid*2, bytes(b))
+
+        #test that pre-serialized AnyMsg data is framed as is
+        anymsg = rospy.msg.AnyMsg()
+        anymsg.deserialize(valid[4:])
+        b = bytearray()
+        rospy.msg.serialize_message(b, seq, anymsg)
+        self.assertEquals(valid, bytes(b))
+        buff.truncate(0)
+        buff.seek(0)
+        rospy.msg.serialize_message(buff, seq, anymsg)
+        self.assertEquals(valid, buff.getvalue())
+        try:
+            rospy.msg.serialize_message(bytearray(), seq, rospy.msg.AnyMsg())
+            self.fail("should not serialize uninitialized AnyMsg")
+        except rospy.exceptions.ROSException: pass
 
         #test sequence parameter
         buff.truncate(0)
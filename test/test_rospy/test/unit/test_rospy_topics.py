@@ -48,12 +48,38 @@ class ConnectionOverride(rospy.impl.transport.Transport):
     def __init__(self, endpoint_id):
         super(ConnectionOverride, self).__init__(rospy.impl.transport.OUTBOUND, endpoint_id)
         self.endpoint_id = endpoint_id
+        self.callerid_pub = endpoint_id
         self.data = b''
 
     def set_cleanup_callback(self, cb): pass
     def write_data(self, data):
         self.data = self.data + data
 
+# stands in for SubscriberStatisticsLogger in receive_callback() tests
+class StatisticsRecorder(object):
+    def __init__(self):
+        self.calls = []
+    def callback(self, msg, publisher, stat_bytes):
+        self.calls.append((msg, publisher))
+    def shutdown(self): pass
+
+# publisher connection whose writes always fail
+class TerminatedConnection(rospy.impl.transport.Transport):
+    def __init__(self, endpoint_id, close_on_write=False):
+        super(TerminatedConnection, self).__init__(rospy.impl.transport.OUTBOUND, endpoint_id)
+        self.endpoint_id = endpoint_id
+        # close before raising, like TCPROSTransport does on EPIPE
+        self.close_on_write = close_on_write
+
+    def close(self):
+        if not self.done:
+            super(TerminatedConnection, self).close()
+
+    def write_data(self, data):
+        if self.close_on_write:
+            self.close()
+        raise rospy.exceptions.TransportTerminated("connection closed")
+
 # test rospy API verifies that the rospy module exports the required symbols
 class TestRospyTopics(unittest.TestCase):
 
@@ -138,7 +164,7 @@ class TestRospyTopics(unittest.TestCase):
         self.assertEquals(None, impl.latch)                
         self.assertEquals(0, impl.seq)
         self.assertEquals(1, impl.ref_count)
-        self.assertEquals(b'', impl.buff.getvalue())
+        self.assertEquals(bytearray(), impl.buff)
         self.failIf(impl.closed)
         self.failIf(impl.has_connections())
         # check publish() fall-through
@@ -149,7 +175,9 @@ class TestRospyTopics(unittest.TestCase):
         self.assertEquals(0, impl.message_data_sent)
         # check acquire/release don't bomb
         impl.acquire()
-        impl.release()        
+        impl.release()
+        with impl:
+            pass
 
         # do a single publish with connection override. The connection
         # override is a major cheat as the object isn't even an actual
@@ -232,6 +260,135 @@ class TestRospyTopics(unittest.TestCase):
         pub = Publisher('header_test', data_class, headers=h, queue_size=0)
         self.assertEquals(h, pub.impl.headers)
         
+    def test_Publisher_reentrant_publish(self):
+        # a SubscribeListener may publish from peer_unsubscribe(),
+        # which is called when a failed write closes a connection
+        # while publish() holds publock
+        import threading
+        import rospy
+        import rospy.msg
+        from rospy.topics import Publisher, SubscribeListener
+        from test_rospy.msg import Val
+
+        class RepublishListener(SubscribeListener):
+            def __init__(self):
+                self.pub = None
+            def peer_unsubscribe(self, topic_name, num_peers):
+                self.pub.publish(Val('goodbye'))
+
+        def packet(msg):
+            b = bytearray()
+            rospy.msg.serialize_message(b, 0, msg)
+            return bytes(b)
+
+        initialized = rospy.core.is_initialized()
+        rospy.core.set_initialized(True)
+        try:
+            # close_on_write: the peer_unsubscribe() publish happens
+            # in the middle of the outer fan-out rather than after it
+            for close_on_write in [False, True]:
+                listener = RepublishListener()
+                pub = Publisher('reentrant_test', Val, subscriber_listener=listener)
+                listener.pub = pub
+                bad = TerminatedConnection('bad', close_on_write)
+                good = ConnectionOverride('good')
+                pub.impl.add_connection(bad)
+                pub.impl.add_connection(good)
+
+                t = threading.Thread(target=pub.publish, args=(Val('hello'),))
+                t.daemon = True
+                t.start()
+                t.join(5.)
+                self.failIf(t.is_alive(), "publish() deadlocked")
+                self.assert_(bad.done)
+                self.failIf(pub.impl.has_connection('bad'))
+                self.assert_(pub.impl.has_connection('good'))
+                # both messages arrive as complete packets
+                if close_on_write:
+                    expected = packet(Val('goodbye')) + packet(Val('hello'))
+                else:
+                    expected = packet(Val('hello')) + packet(Val('goodbye'))
+                self.assertEquals(expected, good.data)
+                pub.unregister()
+        finally:
+            rospy.core.set_initialized(initialized)
+
+    def test_Publisher_serialization_error(self):
+        # a message that fails to serialize must not leave partial
+        # data in the reusable buffer
+        import rospy.msg
+        from rospy.topics import _PublisherImpl
+        from test_rospy.msg import Val
+        impl = _PublisherImpl('/serialization_error', Val)
+        co1 = ConnectionOverride('co1')
+        impl.add_connection(co1)
+        buff = impl.buff
+        try:
+            impl.publish(Val(object()))
+            self.fail("should not serialize an invalid message")
+        except Exception: pass
+        self.assert_(buff is impl.buff)
+        self.assertEquals(bytearray(), impl.buff)
+        self.failIf(impl.in_publish)
+        self.assertEquals(b'', co1.data)
+
+        msg = Val('hello')
+        impl.publish(msg)
+        b = bytearray()
+        rospy.msg.serialize_message(b, 0, msg)
+        self.assertEquals(bytes(b), co1.data)
+        # - the buffer is still reused
+        self.assert_(buff is impl.buff)
+        self.assertEquals(bytearray(), impl.buff)
+        impl.close()
+
+    def test_Publisher_write_data_concat(self):
+        # transports may concatenate the data handed to write_data()
+        # with what they already hold, and must still see each packet
+        # intact after publish() reuses its buffer
+        import rospy.msg
+        from rospy.topics import _PublisherImpl
+        from test_rospy.msg import Val
+        impl = _PublisherImpl('/write_data_concat', Val)
+        co1 = ConnectionOverride('co1')
+        co2 = ConnectionOverride('co2')
+        impl.add_connection(co1)
+        impl.add_connection(co2)
+        expected = b''
+        for i in range(3):
+            msg = Val('message-%s'%i)
+            impl.publish(msg)
+            b = bytearray()
+            rospy.msg.serialize_message(b, 0, msg)
+            expected = expected + bytes(b)
+        self.assertEquals(expected, co1.data)
+        self.assertEquals(expected, co2.data)
+        self.assertEquals(len(expected), impl.message_data_sent)
+        impl.close()
+
+    def test_PublisherImpl_collected_without_gc(self):
+        # the connection's cleanup callback must not keep the impl
+        # alive, so dropping the last reference closes its connections
+        # even when the cyclic garbage collector does not run
+        import gc
+        import weakref
+        from rospy.topics import _PublisherImpl
+        from test_rospy.msg import Val
+        enabled = gc.isenabled()
+        gc.disable()
+        try:
+            impl = _PublisherImpl('/collected_test', Val)
+            c = TerminatedConnection('c1')
+            impl.add_connection(c)
+            self.assert_(c.cleanup_cb is not None)
+            ref = weakref.ref(impl)
+            del impl
+            self.assertEquals(None, ref())
+            self.assert_(c.done)
+        finally:
+            if enabled:
+                gc.enable()
+
     def test_Subscriber_unregister(self):
         # regression test for #3029 (unregistering a Subcriber with no
         # callback) plus other unregistration tests
@@ -254,7 +411,7 @@ class TestRospyTopics(unittest.TestCase):
         impl = get_topic_manager().get_impl(Registration.SUB, rname)
         self.assert_(impl == sub.impl)
         self.assertEquals(1, impl.ref_count)
-        self.assertEquals([], impl.callbacks)
+        self.assertEquals((), impl.callbacks)
         
         # unregister should release the underlying impl
         sub.unregister()
@@ -269,7 +426,7 @@ class TestRospyTopics(unittest.TestCase):
         self.assert_(impl == sub2.impl)
         self.assert_(impl == sub3.impl)
         # - test basic impl state
-        self.assertEquals([], impl.callbacks)
+        self.assertEquals((), impl.callbacks)
         self.assertEquals(2, impl.ref_count)
         sub2.unregister()
         self.assertEquals(1, impl.ref_count)
@@ -294,19 +451,19 @@ class TestRospyTopics(unittest.TestCase):
         impl = get_topic_manager().get_impl(Registration.SUB, rname)
         self.assertEquals(4, impl.ref_count)
         
-        self.assertEquals([(callback1, None), (callback2, cb_args5), (callback2, cb_args6), (callback2, cb_args7)], impl.callbacks)
+        self.assertEquals(((callback1, None), (callback2, cb_args5), (callback2, cb_args6), (callback2, cb_args7)), impl.callbacks)
         # unregister sub6 first to as it is most likely to confuse any callback-finding logic
         sub6.unregister()
-        self.assertEquals([(callback1, None), (callback2, cb_args5), (callback2, cb_args7)], impl.callbacks)
+        self.assertEquals(((callback1, None), (callback2, cb_args5), (callback2, cb_args7)), impl.callbacks)
         self.assertEquals(3, impl.ref_count)
         sub5.unregister()
-        self.assertEquals([(callback1, None), (callback2, cb_args7)], impl.callbacks)
+        self.assertEquals(((callback1, None), (callback2, cb_args7)), impl.callbacks)
         self.assertEquals(2, impl.ref_count)
         sub4.unregister()
-        self.assertEquals([(callback2, cb_args7)], impl.callbacks)
+        self.assertEquals(((callback2, cb_args7),), impl.callbacks)
         self.assertEquals(1, impl.ref_count)
         sub7.unregister()
-        self.assertEquals([], impl.callbacks)
+        self.assertEquals((), impl.callbacks)
         self.assertEquals(0, impl.ref_count)
         self.assertEquals(None, get_topic_manager().get_impl(Registration.SUB, rname))
 
@@ -314,13 +471,13 @@ class TestRospyTopics(unittest.TestCase):
         sub8 = Subscriber(name, data_class, callback1, 'hello')
         sub9 = Subscriber(name, data_class, callback1, 'hello')
         impl = get_topic_manager().get_impl(Registration.SUB, rname)
-        self.assertEquals([(callback1, 'hello'), (callback1, 'hello')], impl.callbacks)
+        self.assertEquals(((callback1, 'hello'), (callback1, 'hello')), impl.callbacks)
         self.assertEquals(2, impl.ref_count)
         sub8.unregister()
-        self.assertEquals([(callback1, 'hello')], impl.callbacks)
+        self.assertEquals(((callback1, 'hello'),), impl.callbacks)
         self.assertEquals(1, impl.ref_count)
         sub9.unregister()
-        self.assertEquals([], impl.callbacks)
+        self.assertEquals((), impl.callbacks)
         self.assertEquals(0, impl.ref_count)
 
     def test_Subscriber(self):
@@ -364,7 +521,7 @@ class TestRospyTopics(unittest.TestCase):
         # verify impl as well
         impl = get_topic_manager().get_impl(Registration.SUB, rname)
         self.assert_(impl == sub.impl)
-        self.assertEquals([], impl.callbacks)
+        self.assertEquals((), impl.callbacks)
         self.assertEquals(rname, impl.resolved_name)
         self.assertEquals(data_class, impl.data_class)                
         self.assertEquals(None, impl.queue_size)
@@ -388,7 +545,7 @@ class TestRospyTopics(unittest.TestCase):
         # verify impl 
         impl2 = get_topic_manager().get_impl(Registration.SUB, rname)
         self.assert_(impl == impl2) # should be same instance
-        self.assertEquals([(callback1, None)], impl.callbacks)
+        self.assertEquals(((callback1, None),), impl.callbacks)
         self.assertEquals(rname, impl.resolved_name)
         self.assertEquals(data_class, impl.data_class)                
         self.assertEquals(queue_size, impl.queue_size)
@@ -418,6 +575,291 @@ class TestRospyTopics(unittest.TestCase):
         self.assertEquals(3, impl.ref_count)
         self.failIf(impl.closed)
 
+    def test_SubscriberImpl_receive_callback_single(self):
+        # single callback without args takes the fast path
+        from rospy.topics import _SubscriberImpl
+        from test_rospy.msg import Val
+        impl = _SubscriberImpl('/receive_single', Val)
+        stats = StatisticsRecorder()
+        impl.statistics_logger = stats
+        received = []
+        impl.add_callback(received.append, None)
+        msgs = [Val('a'), Val('b'), Val('c')]
+        conn = ConnectionOverride('pub1')
+        impl.receive_callback(msgs, conn)
+        self.assertEquals(msgs, received)
+        self.assertEquals([(m, 'pub1') for m in msgs], stats.calls)
+        impl.close()
+
+    def test_SubscriberImpl_receive_callback_multiple(self):
+        # callback args or several callbacks use the generic dispatch
+        from rospy.topics import _SubscriberImpl
+        from test_rospy.msg import Val
+        impl = _SubscriberImpl('/receive_multiple', Val)
+        stats = StatisticsRecorder()
+        impl.statistics_logger = stats
+        received = []
+        def cb(msg, cb_args=None):
+            received.append((msg, cb_args))
+        # - single callback with args
+        impl.add_callback(cb, 'args1')
+        msgs = [Val('a'), Val('b')]
+        conn = ConnectionOverride('pub1')
+        impl.receive_callback(msgs, conn)
+        self.assertEquals([(msgs[0], 'args1'), (msgs[1], 'args1')], received)
+        self.assertEquals([(m, 'pub1') for m in msgs], stats.calls)
+
+        # - several callbacks are invoked in order for each message
+        del received[:]
+        del stats.calls[:]
+        impl.add_callback(cb, None)
+        impl.receive_callback(msgs, conn)
+        self.assertEquals([(msgs[0], 'args1'), (msgs[0], None),
+                           (msgs[1], 'args1'), (msgs[1], None)], received)
+        self.assertEquals([(m, 'pub1') for m in msgs], stats.calls)
+        impl.close()
+
+    def test_SubscriberImpl_receive_callback_no_consumers(self):
+        from rospy.topics import _SubscriberImpl
+        from test_rospy.msg import Val
+
+        class UntouchableConnection(object):
+            def __getattr__(self, name):
+                raise AssertionError("connection.%s should not be accessed"%name)
+
+        impl = _SubscriberImpl('/receive_no_consumers', Val)
+        # - nothing consumes the messages, so they are dropped outright
+        impl.statistics_logger = None
+        impl.receive_callback([Val('a'), Val('b')], UntouchableConnection())
+
+        # - statistics are still recorded without any callbacks
+        stats = StatisticsRecorder()
+        impl.statistics_logger = stats
+        msgs = [Val('a'), Val('b')]
+        impl.receive_callback(msgs, ConnectionOverride('pub1'))
+        self.assertEquals([(m, 'pub1') for m in msgs], stats.calls)
+        impl.close()
+
+    def test_SubscriberImpl_receive_callback_error(self):
+        # a callback that raises is logged and does not stop dispatch
+        import logging
+        import traceback
+        from rospy.topics import _SubscriberImpl
+        from test_rospy.msg import Val
+
+        class RecordingHandler(logging.Handler):
+            def __init__(self):
+                logging.Handler.__init__(self)
+                self.records = []
+            def emit(self, record):
+                self.records.append(record)
+
+        def bad_callback(msg, cb_args=None):
+            raise Exception("bad callback %s"%msg.val)
+
+        rosout = logging.getLogger('rosout')
+        handler = RecordingHandler()
+        rosout.addHandler(handler)
+        level = rosout.level
+        format_exception = traceback.format_exception
+        try:
+            msgs = [Val('a'), Val('b')]
+            conn = ConnectionOverride('pub1')
+            # - single callback fast path keeps going to the next message
+            impl = _SubscriberImpl('/receive_error', Val)
+            impl.statistics_logger = None
+            impl.add_callback(bad_callback, None)
+            impl.receive_callback(msgs, conn)
+            errors = [r for r in handler.records if r.levelno == logging.ERROR]
+            self.assertEquals(2, len(errors))
+            self.assert_('bad callback a' in errors[0].getMessage())
+            self.assert_('bad callback b' in errors[1].getMessage())
+
+            # - generic dispatch keeps going to the next callback
+            del handler.records[:]
+            received = []
+            impl.add_callback(lambda msg, cb_args: received.append(msg), 'args')
+            impl.receive_callback(msgs, conn)
+            self.assertEquals(msgs, received)
+            errors = [r for r in handler.records if r.levelno == logging.ERROR]
+            self.assertEquals(2, len(errors))
+
+            # - the traceback is not formatted if it would not be logged
+            del handler.records[:]
+            del received[:]
+            formatted = []
+            def counting_format_exception(*args):
+                formatted.append(args)
+                return format_exception(*args)
+            traceback.format_exception = counting_format_exception
+            rosout.setLevel(logging.CRITICAL)
+            impl.receive_callback(msgs, conn)
+            self.assertEquals(msgs, received)
+            self.assertEquals([], formatted)
+            self.assertEquals([], [r for r in handler.records if r.levelno == logging.ERROR])
+            impl.close()
+        finally:
+            traceback.format_exception = format_exception
+            rosout.setLevel(level)
+            rosout.removeHandler(handler)
+
+    def test_TopicManager_topics(self):
+        from rospy.impl.registration import Registration
+        from rospy.topics import _TopicManager
+        from test_rospy.msg import Val
+        tm = _TopicManager()
+        tm.acquire_impl(Registration.PUB, '/shared', Val)
+        tm.acquire_impl(Registration.SUB, '/shared', Val)
+        tm.acquire_impl(Registration.SUB, '/sub_only', Val)
+        self.assertEquals(set(['/shared', '/sub_only']), tm.get_topics())
+        # - topic stays while the subscription still uses it
+        tm.release_impl(Registration.PUB, '/shared')
+        self.assertEquals(set(['/shared', '/sub_only']), tm.get_topics())
+        tm.release_impl(Registration.SUB, '/shared')
+        self.assertEquals(set(['/sub_only']), tm.get_topics())
+        tm.release_impl(Registration.SUB, '/sub_only')
+        self.assertEquals(set(), tm.get_topics())
+        # - get_topics() returns a copy
+        tm.get_topics().add('/foo')
+        self.assertEquals(set(), tm.get_topics())
+
+    def test_TopicManager_get_publications_subscriptions(self):
+        import threading
+        from rospy.impl.registration import Registration
+        from rospy.topics import _TopicManager
+        from test_rospy.msg import Val
+        tm = _TopicManager()
+        self.assertEquals([], tm.get_publications())
+        self.assertEquals([], tm.get_subscriptions())
+        tm.acquire_impl(Registration.PUB, '/pub1', Val)
+        tm.acquire_impl(Registration.PUB, '/pub2', Val)
+        tm.acquire_impl(Registration.SUB, '/sub1', Val)
+        self.assertEquals([('/pub1', 'test_rospy/Val'), ('/pub2', 'test_rospy/Val')],
+                          sorted(tm.get_publications()))
+        self.assertEquals([('/sub1', 'test_rospy/Val')], tm.get_subscriptions())
+
+        # - callers cannot modify the cached lists
+        tm.get_publications().append(('/foo', 'test_rospy/Val'))
+        del tm.get_subscriptions()[:]
+        self.assertEquals(2, len(tm.get_publications()))
+        self.assertEquals([('/sub1', 'test_rospy/Val')], tm.get_subscriptions())
+
+        # - the cached list is reused until pubs change
+        self.assert_(tm.get_publications()[0] is tm.get_publications()[0])
+        # - a rebuild that raced a change and was stored late is not used
+        tm._pub_list = (tm._pub_version - 1, ())
+        self.assertEquals(2, len(tm.get_publications()))
+
+        # - updated on release
+        tm.release_impl(Registration.PUB, '/pub1')
+        self.assertEquals([('/pub2', 'test_rospy/Val')], tm.get_publications())
+        self.assertEquals([('/sub1', 'test_rospy/Val')], tm.get_subscriptions())
+
+        # - readable while another thread holds the manager lock, as
+        # RegManager does while it talks to the master
+        results = []
+        def get_lists():
+            results.append((tm.get_publications(), tm.get_subscriptions()))
+        with tm.lock:
+            t = threading.Thread(target=get_lists)
+            t.daemon = True
+            t.start()
+            t.join(5.)
+            self.failIf(t.is_alive(), "get_publications() blocked on the manager lock")
+        self.assertEquals([([('/pub2', 'test_rospy/Val')], [('/sub1', 'test_rospy/Val')])], results)
+
+        # - cleared by close_all()
+        tm.close_all()
+        self.assertEquals([], tm.get_publications())
+        self.assertEquals([], tm.get_subscriptions())
+
+    def test_TopicManager_notify(self):
+        import threading
+        from rospy.impl.registration import Registration, RegistrationListener, get_registration_listeners
+        from rospy.topics import _TopicManager
+        from test_rospy.msg import Val
+        tm = _TopicManager()
+
+        def lock_is_free():
+            # tm.lock is reentrant, so test it from another thread
+            free = []
+            def try_lock():
+                if tm.lock.acquire(False):
+                    tm.lock.release()
+                    free.append(True)
+            t = threading.Thread(target=try_lock)
+            t.start()
+            t.join()
+            return bool(free)
+
+        class Listener(RegistrationListener):
+            def __init__(self):
+                self.events = []
+            def reg_added(self, resolved_name, data_type_or_uri, reg_type):
+                self.events.append(('add', resolved_name, data_type_or_uri, reg_type, lock_is_free()))
+            def reg_removed(self, resolved_name, data_type_or_uri, reg_type):
+                self.events.append(('rm', resolved_name, data_type_or_uri, reg_type, lock_is_free()))
+
+        listeners = get_registration_listeners()
+        l = Listener()
+        listeners.add_listener(l)
+        try:
+            # - listeners are notified without the manager lock held
+            tm.acquire_impl(Registration.PUB, '/notify', Val)
+            tm.acquire_impl(Registration.PUB, '/notify', Val)
+            tm.release_impl(Registration.PUB, '/notify')
+            tm.release_impl(Registration.PUB, '/notify')
+            self.assertEquals([('add', '/notify', 'test_rospy/Val', Registration.PUB, True),
+                               ('rm', '/notify', 'test_rospy/Val', Registration.PUB, True)],
+                              l.events)
+
+            # - a re-creation racing a slow removal is reported after it
+            tm.acquire_impl(Registration.PUB, '/notify', Val)
+            del l.events[:]
+            removing = threading.Event()
+            notify_removed = listeners.notify_removed
+            def slow_notify_removed(*args):
+                removing.set()
+                time.sleep(0.3)
+                notify_removed(*args)
+            listeners.notify_removed = slow_notify_removed
+            t1 = threading.Thread(target=tm.release_impl, args=(Registration.PUB, '/notify'))
+            t1.start()
+            self.assert_(removing.wait(5.))
+            t2 = threading.Thread(target=tm.acquire_impl, args=(Registration.PUB, '/notify', Val))
+            t2.start()
+            t1.join(5.)
+            t2.join(5.)
+            self.assertEquals(['rm', 'add'], [e[0] for e in l.events])
+            self.assert_(tm.has_publication('/notify'))
+
+            # - while a slow removal is reported and a new registration
+            #   waits for it, the manager lock stays available
+            tm.acquire_impl(Registration.PUB, '/existing', Val)
+            removing.clear()
+            t1 = threading.Thread(target=tm.release_impl, args=(Registration.PUB, '/notify'))
+            t1.start()
+            self.assert_(removing.wait(5.))
+            t2 = threading.Thread(target=tm.acquire_impl, args=(Registration.SUB, '/pending', Val))
+            t2.start()
+            time.sleep(0.05)
+            self.assert_(t2.is_alive())
+            start = time.time()
+            tm.get_pub_sub_stats()
+            tm.acquire_impl(Registration.PUB, '/existing', Val)
+            self.assert_(time.time() - start < 0.2)
+            self.assert_(lock_is_free())
+            t1.join(5.)
+            t2.join(5.)
+            self.failIf(tm.has_publication('/notify'))
+            self.assert_(tm.has_subscription('/pending'))
+            self.assertEquals(2, tm.get_impl(Registration.PUB, '/existing').ref_count)
+        finally:
+            if 'notify_removed' in listeners.__dict__:
+                del listeners.notify_removed
+            with listeners.lock:
+                listeners.listeners.remove(l)
+
     def test_Poller(self):
         # no real test as this goes down to kqueue/select, just make sure that it behaves
         from rospy.topics import Poller